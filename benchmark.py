@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# Headless benchmark of the path planner: graph build, search and smoothing on synthetic maps
+# Uses the planning core directly, without ROS, and saves the results as JSON so they can be compared across commits
+# Exits with status 1 if the exact searches (all but hierarchical) find paths of different costs for the same query
+#
+#   python3 benchmark.py --output results.json
+#   python3 benchmark.py --sizes 256 --maps maze --graphs grid prm --compare results.json
+
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cv2 as cv
+import numpy as np
+
+import path_planner
+
+
+MAPS = ["empty", "clutter", "maze", "corridors"]
+GRAPHS = ["grid", "jps", "quadtree", "prm", "lazy_prm"]
+SEARCHES = ["astar", "bidirectional", "incremental", "alt", "hierarchical", "batch"]
+
+# Graphs with the same nodes and edges, whose exact searches must find paths of the same cost
+GRAPH_FAMILIES = {"grid": "grid", "jps": "grid", "quadtree": "quadtree", "prm": "prm", "lazy_prm": "prm"}
+# Searches whose paths may be longer than the shortest ones, left out of the cost check
+APPROXIMATE_SEARCHES = ["hierarchical"]
+# Landmarks of the alt search when the graph has none (--alt-landmarks 0)
+ALT_LANDMARKS = 8
+
+
+def empty_map(size, rng):
+    # Free space inside a 2 pixel wall
+
+    image = np.full((size, size), 255, dtype=np.uint8)
+    image[:2,:] = 0
+    image[-2:,:] = 0
+    image[:,:2] = 0
+    image[:,-2:] = 0
+    return image
+
+def clutter_map(size, rng, density=0.2):
+    # Random rectangles and discs covering about density of the map
+
+    image = empty_map(size, rng)
+    target = density * size * size
+    while np.count_nonzero(image == 0) < target:
+        x, y = rng.integers(0, size, 2).tolist()
+        r = int(rng.integers(size // 64 + 2, size // 16 + 3))
+        if rng.random() < 0.5:
+            cv.circle(image, (y, x), r, 0, -1)
+        else:
+            cv.rectangle(image, (y - r, x - r // 2), (y + r, x + r // 2), 0, -1)
+    return image
+
+def maze_map(size, rng, cells=16):
+    # Perfect maze of cells x cells, carved with a randomised depth first search
+
+    image = np.zeros((size, size), dtype=np.uint8)
+    cell = size // cells
+    wall = max(2, cell // 5)
+
+    visited = np.zeros((cells, cells), dtype=bool)
+    stack = [(0, 0)]
+    visited[0, 0] = True
+    while len(stack) > 0:
+        r, c = stack[-1]
+        image[r*cell+wall:(r+1)*cell, c*cell+wall:(c+1)*cell] = 255
+
+        moves = [(dr, dc) for dr, dc in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                 if 0 <= r + dr < cells and 0 <= c + dc < cells and not visited[r + dr, c + dc]]
+        if len(moves) == 0:
+            stack.pop()
+            continue
+
+        dr, dc = moves[rng.integers(len(moves))]
+        nr, nc = r + dr, c + dc
+        visited[nr, nc] = True
+
+        # Knock down the wall between the cells
+        r0, r1 = min(r, nr), max(r, nr)
+        c0, c1 = min(c, nc), max(c, nc)
+        image[r0*cell+wall:(r1+1)*cell, c0*cell+wall:(c1+1)*cell] = 255
+        stack.append((nr, nc))
+
+    # Close the bottom and right sides
+    image[cells*cell-wall:,:] = 0
+    image[:,cells*cell-wall:] = 0
+    return image
+
+def corridors_map(size, rng, width=8):
+    # Serpentine of narrow corridors, width pixels wide, joined by gaps at alternating ends
+
+    image = empty_map(size, rng)
+    pitch = 2 * width
+    for k, x in enumerate(range(pitch, size - pitch, pitch)):
+        image[x:x+width,:] = 0
+        gap = slice(2, 2 + width) if k % 2 == 0 else slice(size - 2 - width, size - 2)
+        image[x:x+width, gap] = 255
+    return image
+
+def make_map(name, size, seed):
+    return {"empty": empty_map, "clutter": clutter_map, "maze": maze_map, "corridors": corridors_map}[name](size, np.random.default_rng(seed))
+
+
+@contextlib.contextmanager
+def measure(record, trace_memory):
+    # Add the wall time of the block, and the peak resident memory of the process so far, to record
+    # With trace_memory, also the peak memory allocated in the block (tracing slows down the Python code)
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record["wall_time_s"] = time.perf_counter() - start
+        record["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        if trace_memory:
+            record["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+
+def add_stats(record, map):
+    # With --stats, add the planner's phase times and counters since the last record
+
+    stats = map.stats_.report(record["phase"])
+    if stats is not None:
+        record["stats"] = stats
+
+def make_queries(map, count, seed):
+    # count (start, goal) pairs of free pixels, the same for every graph on a map
+
+    free = np.argwhere(~map.is_occupied_array(np.arange(map.max_x_)[:,np.newaxis], np.arange(map.max_y_)[np.newaxis,:]))
+    rng = np.random.default_rng(seed)
+    pairs = free[rng.integers(0, len(free), (count, 2))]
+    return [(start.tolist(), goal.tolist()) for start, goal in pairs]
+
+def path_cost(path):
+    if isinstance(path, np.ndarray):
+        return float(np.sqrt((np.diff(path.astype(np.float64), axis=0)**2).sum(axis=1)).sum())
+    return sum(a.distance_to(b) for a, b in zip(path[:-1], path[1:]))
+
+def make_planner(graph, search):
+    # A function planning a path between two pixels, it returns the path and the number of nodes expanded
+
+    if graph.jump_point_search_:
+        planner = path_planner.JumpPointSearch(graph)
+    elif search == "incremental":
+        planner = path_planner.IncrementalGraphSearch(graph)
+    elif search == "hierarchical":
+        planner = path_planner.HierarchicalGraphSearch(graph) # Builds the cluster tables
+    else:
+        def plan(start_xy, goal_xy):
+            graph_search = path_planner.GraphSearch(graph, start_xy, goal_xy)
+            return graph_search.path_, graph_search.expansions_
+        return plan
+
+    def plan(start_xy, goal_xy):
+        path = planner.plan(start_xy, goal_xy)
+        return path, planner.expansions_
+    return plan
+
+def benchmark(map_name, size, graph_name, args, results, costs):
+    # Build one graph of one map, then time each search and the smoothing of its paths
+    # The cost of each query's path (None if unsolved) by each exact search is added to costs, see cost_mismatches
+
+    seed = args.seed
+    config = path_planner.PlannerConfig(
+        grid_step_size=args.grid_step,
+        grid_connectivity=args.grid_connectivity,
+        prm_num_nodes=max(2, int(args.prm_density * size * size)),
+        prm_max_edge_length=args.prm_max_edge_length,
+        prm_seed=seed,
+        use_prm=graph_name in ("prm", "lazy_prm"),
+        use_quadtree=graph_name == "quadtree",
+        quadtree_min_size=args.quadtree_min_size,
+        quadtree_max_size=args.quadtree_max_size,
+        lazy_prm=graph_name == "lazy_prm",
+        jump_point_search=graph_name == "jps",
+        robot_radius=args.robot_radius,
+        graph_workers=args.workers,
+        plan_workers=args.plan_workers,
+        alt_landmarks=args.alt_landmarks,
+        hpa_cluster_size=args.hpa_cluster_size,
+        map_tile_dir=args.map_tile_dir or "",
+        shortcut_path=args.shortcut,
+        stats=args.stats,
+        stats_log_level="",
+    )
+    base = {"map": map_name, "size": size, "graph": graph_name}
+    image = make_map(map_name, size, seed)
+    if args.map_tile_dir:
+        # Load it from a file, as a TiledMap
+        filename = os.path.join(args.map_tile_dir, "%s_%d.npy" % (map_name, size))
+        os.makedirs(args.map_tile_dir, exist_ok=True)
+        np.save(filename, image)
+
+    record = dict(base, phase="map")
+    with measure(record, args.trace_memory):
+        if args.map_tile_dir:
+            map = path_planner.Map.from_file(filename, config)
+        else:
+            map = path_planner.Map(image, config, "%s_%d" % (map_name, size))
+    add_stats(record, map)
+    results.append(record)
+
+    record = dict(base, phase="build")
+    with measure(record, args.trace_memory):
+        graph = path_planner.Graph(map, config)
+    record["nodes"] = len(graph.xy_)
+    record["edges"] = len(graph.indices_)
+    record["collision_checks"] = map.collision_checks_
+    add_stats(record, map)
+    results.append(record)
+
+    queries = make_queries(map, args.queries, seed + size)
+    searches = ["jps"] if graph_name == "jps" else args.searches
+    query_costs = costs.setdefault((map_name, size, GRAPH_FAMILIES[graph_name]), {})
+    if graph_name == "jps" and "batch" in args.searches:
+        searches = searches + ["batch"]
+
+    for search in searches:
+        config.bidirectional_search = search == "bidirectional"
+
+        # A* with the ALT heuristic, the landmarks are only picked for it if the graph has none
+        own_landmarks = search == "alt" and graph.landmarks_ is None
+        if own_landmarks:
+            graph.create_landmarks(ALT_LANDMARKS)
+
+        record = dict(base, phase="search", search=search, queries=len(queries))
+        checks = map.collision_checks_
+        if search == "batch":
+            # All the queries in one BatchPlanner.plan_many call, on ~plan_workers processes
+            # The workers' expansions aren't counted
+            with path_planner.BatchPlanner(graph) as planner:
+                with measure(record, args.trace_memory):
+                    paths = planner.plan_many(queries)
+        else:
+            plan = make_planner(graph, search)
+            expansions = 0
+            paths = []
+            with measure(record, args.trace_memory):
+                for start_xy, goal_xy in queries:
+                    path, path_expansions = plan(start_xy, goal_xy)
+                    paths.append(path)
+                    expansions = expansions + path_expansions
+            record["expansions"] = expansions
+        record["collision_checks"] = map.collision_checks_ - checks
+        record["solved"] = sum(1 for path in paths if len(path) > 1)
+        record["path_cost"] = sum(path_cost(path) for path in paths if len(path) > 1)
+        add_stats(record, map)
+        results.append(record)
+
+        if own_landmarks:
+            graph.set_landmarks(None, None, None)
+        if search not in APPROXIMATE_SEARCHES:
+            query_costs["%s/%s" % (graph_name, search)] = [path_cost(path) if len(path) > 1 else None for path in paths]
+
+        record = dict(base, phase="smooth", search=search, queries=len(queries))
+        checks = map.collision_checks_
+        with measure(record, args.trace_memory):
+            waypoints = sum(len(path_planner.PathSmoother(graph, path).path_) for path in paths)
+        record["waypoints"] = waypoints
+        record["collision_checks"] = map.collision_checks_ - checks
+        add_stats(record, map)
+        results.append(record)
+
+def cost_mismatches(costs, tolerance):
+    # Queries on which the exact searches of a graph family disagree, one solving it and another not,
+    # or their path costs differing by more than tolerance relative to the lowest
+
+    mismatches = []
+    for (map_name, size, family), searches in costs.items():
+        for query, query_costs in enumerate(zip(*searches.values())):
+            solved = [cost for cost in query_costs if cost is not None]
+            if len(solved) == 0:
+                continue
+            if len(solved) < len(query_costs) or max(solved) - min(solved) > tolerance * max(min(solved), 1.0):
+                mismatches.append({"map": map_name, "size": size, "graph": family, "query": query,
+                                   "costs": dict(zip(searches, query_costs))})
+    return mismatches
+
+def result_key(record):
+    return tuple(record.get(name) for name in ("map", "size", "graph", "phase", "search"))
+
+def compare(results, baseline_file):
+    # Print the change in wall time against the results of an earlier run
+
+    with open(baseline_file) as f:
+        baseline = {result_key(record): record for record in json.load(f)["results"]}
+
+    print("%-40s %12s %12s %8s" % ("", "baseline s", "s", "ratio"))
+    for record in results:
+        old = baseline.get(result_key(record))
+        if old is None:
+            continue
+        name = "/".join(str(value) for value in result_key(record) if value is not None)
+        ratio = record["wall_time_s"] / old["wall_time_s"] if old["wall_time_s"] > 0 else math.inf
+        print("%-40s %12.4f %12.4f %8.2f" % (name, old["wall_time_s"], record["wall_time_s"], ratio))
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless path planner benchmark")
+    parser.add_argument("--maps", nargs="+", choices=MAPS, default=MAPS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[256, 512])
+    parser.add_argument("--graphs", nargs="+", choices=GRAPHS, default=GRAPHS)
+    parser.add_argument("--searches", nargs="+", choices=SEARCHES, default=SEARCHES)
+    parser.add_argument("--queries", type=int, default=20, help="queries per map")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the maps, queries and PRM sampling")
+    parser.add_argument("--grid-step", type=int, default=5)
+    parser.add_argument("--grid-connectivity", type=int, choices=[4, 8], default=8)
+    parser.add_argument("--quadtree-min-size", type=int, default=4)
+    parser.add_argument("--quadtree-max-size", type=int, default=64)
+    parser.add_argument("--prm-density", type=float, default=0.0025, help="PRM nodes per pixel")
+    parser.add_argument("--prm-max-edge-length", type=float, default=40)
+    parser.add_argument("--robot-radius", type=float, default=2.0)
+    parser.add_argument("--alt-landmarks", type=int, default=0, help="~alt_landmarks of the A* heuristic")
+    parser.add_argument("--hpa-cluster-size", type=int, default=64, help="~hpa_cluster_size of the hierarchical search")
+    parser.add_argument("--workers", type=int, default=1, help="~graph_workers")
+    parser.add_argument("--plan-workers", type=int, default=1, help="~plan_workers of the batch search")
+    parser.add_argument("--map-tile-dir", help="~map_tile_dir, load the maps as TiledMaps converted here")
+    parser.add_argument("--shortcut", action="store_true", help="shortcut the paths before smoothing")
+    parser.add_argument("--trace-memory", action="store_true", help="record the memory allocated in each phase")
+    parser.add_argument("--stats", action="store_true", help="record the planner stats (see PlannerStats) of each phase")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--cost-tolerance", type=float, default=1e-4,
+                        help="relative difference of the path costs of the exact searches reported as a mismatch")
+    args = parser.parse_args()
+
+    # Unreachable queries are expected on the cluttered maps, don't warn about them
+    logging.getLogger("path_planner").setLevel(logging.ERROR)
+
+    results = []
+    costs = {}
+    for map_name in args.maps:
+        for size in args.sizes:
+            for graph_name in args.graphs:
+                first = len(results)
+                benchmark(map_name, size, graph_name, args, results, costs)
+                for record in results[first:]:
+                    print("%-10s %5d %-9s %-7s %-14s %8.3f s" % (map_name, size, graph_name, record["phase"],
+                                                                record.get("search", ""), record["wall_time_s"]))
+
+    output = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "opencv": cv.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "args": vars(args),
+        "results": results,
+        "cost_mismatches": cost_mismatches(costs, args.cost_tolerance),
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=1)
+
+    if args.compare:
+        compare(results, args.compare)
+
+    # The exact searches must agree, fail the run if they don't
+    for mismatch in output["cost_mismatches"]:
+        print("Path costs differ: %s %d %s query %d: %s" % (mismatch["map"], mismatch["size"], mismatch["graph"], mismatch["query"],
+              ", ".join("%s %s" % (name, "unsolved" if cost is None else "%.3f" % cost) for name, cost in mismatch["costs"].items())))
+    if len(output["cost_mismatches"]) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import path_planner as pp
+
+
+def empty_graph(config, size=64):
+    # Grid graph on an obstacle free size x size map
+
+    image = np.full((size, size), 255, dtype=np.uint8)
+    return pp.Graph(pp.Map(image, config), config)
+
+
+def zigzag_path(length=50, amplitude=4.0):
+    # Waypoints along x, alternating amplitude px either side of y = 32
+
+    x = np.arange(length, dtype=np.float64) + 8.0
+    y = 32.0 + amplitude * (np.arange(length) % 2 * 2 - 1)
+    return np.stack([x, y], axis=1)
+
+
+def test_smoothing_weights_validated():
+    for alpha, beta in ((0.1, 0.5), (-0.1, 0.3), (0.1, -0.3)):
+        with pytest.raises(ValueError):
+            pp.PlannerConfig(alpha=alpha, beta=beta)
+    pp.PlannerConfig(alpha=0.0, beta=0.5)
+
+
+@pytest.mark.parametrize("alpha, beta", [(0.1, 0.3), (0.0, 0.5), (0.1, 0.5), (0.1, 0.7)])
+def test_smoothing_bounded(alpha, beta):
+    # Updating every waypoint at once from the old neighbours blew up to ~1e40 px for beta = 0.5
+    # Weights past the config's check are set directly, smoothing must still stay inside the path's band
+
+    config = pp.PlannerConfig()
+    graph = empty_graph(config)
+    config.alpha = alpha
+    config.beta = beta
+
+    path = zigzag_path()
+    path_smooth = pp.PathSmoother(graph, path).path_
+    assert np.all(np.isfinite(path_smooth))
+    assert np.all(path_smooth >= path.min(axis=0) - 1e-6) and np.all(path_smooth <= path.max(axis=0) + 1e-6)
+    assert np.array_equal(path_smooth[[0, -1]], path[[0, -1]])
+
+
+@pytest.mark.parametrize("connectivity", [4, 8])
+def test_quadtree_connected_as_grid(connectivity):
+    # A mixed cell's node used to be left without edges where the free pixels only wind through the cell
+
+    import benchmark
+
+    image = benchmark.make_map("clutter", 512, 1)
+    groups = {}
+    for use_quadtree in (False, True):
+        config = pp.PlannerConfig(robot_radius=2, grid_connectivity=connectivity, grid_step_size=1, use_quadtree=use_quadtree)
+        graph = pp.Graph(pp.Map(image, config), config)
+        groups[use_quadtree] = len(np.unique(graph.find_connected_groups()))
+    assert groups[True] <= groups[False]
+
+
+def test_incremental_search_reuses_trees():
+    # A route through the same goals again only walks the kept trees, the LPA* tree used to move on with each goal
+
+    import benchmark
+
+    config = pp.PlannerConfig(robot_radius=2, grid_connectivity=8, incremental_search=True)
+    graph = pp.Graph(pp.Map(benchmark.make_map("clutter", 512, 0), config), config)
+    goals = [start for start, _ in benchmark.make_queries(graph.map_, 4, 0)]
+    route = goals * 2 + goals[:1]
+
+    search = pp.IncrementalGraphSearch(graph)
+    expansions = []
+    for start, goal in zip(route[:-1], route[1:]):
+        search.plan(start, goal)
+        expansions.append(search.expansions_)
+    assert sum(expansions[:4]) > 0
+    assert expansions[4:] == [0] * 4